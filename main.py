@@ -3,13 +3,17 @@ import os
 import asyncio
 import random
 import time
-import json
+import itertools
 import logging
-from typing import Dict, Any
+from typing import Dict, Any, List, Optional, Tuple
 
+import orjson
 from aiogram import Bot, Dispatcher, types
-from aiogram.filters import Command
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.filters import Command, CommandObject
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReturnDocument, UpdateOne, WriteConcern
+from pymongo.errors import BulkWriteError, DuplicateKeyError
 
 # ---------- LOGGING ----------
 logging.basicConfig(level=logging.INFO)
@@ -28,39 +32,83 @@ if not MONGODB_URI:
     raise SystemExit("MONGODB_URI environment variable required.")
 
 # ---------- BOT / DP ----------
-bot = Bot(token=TOKEN)
+# orjson for Telegram API (de)serialization; dumps returns bytes, aiogram wants str
+session = AiohttpSession(json_loads=orjson.loads, json_dumps=lambda obj: orjson.dumps(obj).decode())
+bot = Bot(token=TOKEN, session=session)
 dp = Dispatcher()
 
 # ---------- DB CLIENT ----------
-mongo = AsyncIOMotorClient(MONGODB_URI)
+# handlers are async, so a small pool is enough to keep the server busy
+mongo = AsyncIOMotorClient(
+    MONGODB_URI,
+    maxPoolSize=int(os.getenv("MONGO_MAX_POOL", "20")),
+    minPoolSize=int(os.getenv("MONGO_MIN_POOL", "5")),
+    waitQueueTimeoutMS=2000,
+    serverSelectionTimeoutMS=3000,
+    # zstd when available (pymongo[zstd]), zlib is always there as a fallback
+    compressors="zstd,zlib",
+    zlibCompressionLevel=3,
+)
 db = mongo[DB_NAME]
+# unjournaled writes for data that is fine to lose on a crash: pending
+# catches and last_catch timestamps written by /catch. Claims, including
+# taking the pending doc, keep the default write concern.
+FAST_WC = WriteConcern(w=1, j=False)
+pending_coll = db.get_collection("pending", write_concern=FAST_WC)
+users_fast = db.get_collection("users", write_concern=FAST_WC)
 
 # Collections:
 # db.waifus  - documents of waifus {id,name,img,tags}
-# db.users   - per user {user_id, waifus: [{waifu_id,count,rarity,...}], stats...}
+# db.users   - per user {user_id, last_catch, total_waifus, rarity_counts: {rarity: count}}
+# db.inventory - owned waifus {user_id, waifu_id, name, img, rarity, count}
 # db.pending - pending catches for user {user_id, waifu_id, rarity, ts}
-# db.meta    - any meta info
+# db.meta    - any meta info (e.g. one-time migration markers)
 
 # ---------- SETTINGS ----------
 COOLDOWN_SECONDS = int(os.getenv("COOLDOWN", "15"))
+INVENTORY_PAGE_SIZE = 20
+INVENTORY_MAX_PAGE = 10000  # keeps skip well inside what the server accepts
+WAIFU_CACHE_TTL = int(os.getenv("WAIFU_CACHE_TTL", "600"))  # seconds between cache refreshes
+WAIFU_CACHE_MISS_RETRY = 60  # min seconds between reloads while the cache is empty
+NAME_CACHE_TTL = 3600  # seconds to remember a user's display name
 RARITY_WEIGHTS = [
     ("Legendary", 2),   # 2%
     ("Epic", 8),        # 8%
     ("Rare", 20),       # 20%
     ("Common", 70)      # 70%
 ]
-# convert weights to normalized list for random choice
-def build_rarity_choice():
-    items = []
-    for r, w in RARITY_WEIGHTS:
-        items.extend([r] * w)
-    return items
-
-RARITY_CHOICES = build_rarity_choice()
+# precomputed cumulative weights for random.choices
+RARITY_NAMES = [r for r, _ in RARITY_WEIGHTS]
+RARITY_CUM = list(itertools.accumulate(w for _, w in RARITY_WEIGHTS))
+
+# in-memory copy of db.waifus so /catch doesn't hit the DB to pick one
+WAIFU_CACHE: List[Dict[str, Any]] = []
+WAIFU_CACHE_LAST_LOAD = 0.0  # time.monotonic() of the last load attempt
+_waifu_cache_task: Optional[asyncio.Task] = None
+# user_id -> (display name, fetched at) for the leaderboard
+NAME_CACHE: Dict[int, Tuple[str, float]] = {}
+
+# ---------- TEXTS ----------
+START_TEXT = (
+    "🔥 Welcome to Waifu Catcher!\n\n"
+    "Commands:\n"
+    "/catch - roll for a waifu (then /claim)\n"
+    "/claim - claim your last rolled waifu\n"
+    "/inventory [page] - see your collection\n"
+    "/profile - your stats\n"
+    "/leaderboard - top collectors\n"
+)
+CATCH_TEMPLATE = (
+    "🎴 A Waifu appeared!\n\n"
+    "❤️ Name: {name}\n"
+    "⭐ Rarity: {rarity}\n\n"
+    "Use /claim to add her to your collection."
+)
 
 # ---------- HELPERS ----------
 async def ensure_waifus_loaded():
-    existing = await db.waifus.count_documents({})
+    # collection metadata is enough to tell whether anything is loaded
+    existing = await db.waifus.estimated_document_count()
     if existing > 0:
         logger.info(f"Waifus already present: {existing}")
         return
@@ -70,8 +118,8 @@ async def ensure_waifus_loaded():
     if not os.path.exists(path):
         logger.warning("waifus.json not found; start with empty DB.")
         return
-    with open(path, "r", encoding="utf-8") as f:
-        data = json.load(f)
+    with open(path, "rb") as f:
+        data = orjson.loads(f.read())
     if not isinstance(data, list):
         logger.warning("waifus.json should contain a JSON array.")
         return
@@ -85,203 +133,371 @@ async def ensure_waifus_loaded():
         }
         docs.append(doc)
     if docs:
-        await db.waifus.insert_many(docs)
-        logger.info(f"Inserted {len(docs)} waifus to DB.")
-
-def choose_random_waifu():
-    # choose random waifu document id from DB
-    # We'll pick a random document by sampling count + skip (simple approach)
-    # For large collections consider preloading IDs or use aggregation $sample
-    return None  # placeholder; we use async version below
+        # unordered so the server can insert in parallel and skip past duplicates
+        try:
+            res = await db.waifus.insert_many(docs, ordered=False)
+            inserted = len(res.inserted_ids)
+        except BulkWriteError as e:
+            errors = e.details.get("writeErrors", [])
+            other = [err for err in errors if err.get("code") != 11000]
+            if other:
+                raise
+            inserted = e.details.get("nInserted", 0)
+            logger.warning(f"Skipped {len(errors)} duplicate waifus.")
+        logger.info(f"Inserted {inserted} waifus to DB.")
+
+async def dedupe_by(coll, key: str):
+    # older versions upserted without a unique index, so concurrent commands
+    # could leave several docs per key; keep the newest so the index can build
+    pipeline = [
+        {"$sort": {"_id": -1}},
+        {"$group": {"_id": f"${key}", "ids": {"$push": "$_id"}, "n": {"$sum": 1}}},
+        {"$match": {"n": {"$gt": 1}}},
+    ]
+    extra = []
+    async for group in coll.aggregate(pipeline, allowDiskUse=True):
+        extra.extend(group["ids"][1:])
+    if extra:
+        await coll.delete_many({"_id": {"$in": extra}})
+        logger.warning(f"Removed {len(extra)} duplicate {coll.name} docs by {key}.")
+
+async def merge_duplicate_users():
+    # like dedupe_by, but user docs carry the collection, so fold every
+    # duplicate into the oldest doc instead of dropping any of them
+    pipeline = [
+        {"$group": {"_id": "$user_id", "ids": {"$push": "$_id"}, "n": {"$sum": 1}}},
+        {"$match": {"n": {"$gt": 1}}},
+    ]
+    merged = 0
+    async for group in db.users.aggregate(pipeline, allowDiskUse=True):
+        docs = await db.users.find({"_id": {"$in": group["ids"]}}).sort("_id", 1).to_list(None)
+        waifus_map = {}
+        rarity_counts = {}
+        total = None
+        last_catch = 0
+        for d in docs:
+            for wid, info in d.get("waifus_map", {}).items():
+                entry = waifus_map.setdefault(wid, {**info, "count": 0})
+                entry["count"] += info.get("count", 0)
+            for rarity, count in d.get("rarity_counts", {}).items():
+                rarity_counts[rarity] = rarity_counts.get(rarity, 0) + count
+            if "total_waifus" in d:
+                total = (total or 0) + d["total_waifus"]
+            last_catch = max(last_catch, d.get("last_catch", 0))
+        update = {"last_catch": last_catch}
+        if waifus_map:
+            update["waifus_map"] = waifus_map
+        if total is not None:
+            update["total_waifus"] = total
+            update["rarity_counts"] = rarity_counts
+        await db.users.update_one({"_id": docs[0]["_id"]}, {"$set": update})
+        await db.users.delete_many({"_id": {"$in": [d["_id"] for d in docs[1:]]}})
+        merged += len(docs) - 1
+    if merged:
+        logger.warning(f"Merged {merged} duplicate users docs.")
+
+async def migrate_legacy_users():
+    # users who claimed before db.inventory existed keep their collection
+    # inline as waifus_map: move it over and fill in the counters.
+    # Runs once; the marker in db.meta skips the users scan on later starts.
+    if await db.meta.find_one({"_id": "inventory_migration"}):
+        return
+    cursor = db.users.find({"waifus_map": {"$exists": True}}, {"user_id": 1, "waifus_map": 1, "total_waifus": 1})
+    migrated = 0
+    async for d in cursor:
+        ops = []
+        total = 0
+        rarity_counts = {}
+        for wid, info in d["waifus_map"].items():
+            rarity = info.get("rarity", "Unknown")
+            count = info.get("count", 0)
+            rarity_counts[rarity] = rarity_counts.get(rarity, 0) + count
+            total += count
+            ops.append(UpdateOne(
+                {"user_id": d["user_id"], "waifu_id": wid},
+                {"$setOnInsert": {"name": info.get("name"), "img": info.get("img"), "rarity": rarity, "count": count}},
+                upsert=True
+            ))
+        if ops:
+            await db.inventory.bulk_write(ops, ordered=False)
+        update = {"$unset": {"waifus_map": ""}}
+        if "total_waifus" not in d:
+            update["$set"] = {"total_waifus": total, "rarity_counts": rarity_counts}
+        await db.users.update_one({"_id": d["_id"]}, update)
+        migrated += 1
+    if migrated:
+        logger.info(f"Migrated {migrated} users to inventory.")
+    await db.meta.update_one({"_id": "inventory_migration"}, {"$set": {"done_ts": int(time.time())}}, upsert=True)
+
+async def _load_waifu_cache():
+    global WAIFU_CACHE, WAIFU_CACHE_LAST_LOAD
+    WAIFU_CACHE_LAST_LOAD = time.monotonic()
+    docs = await db.waifus.find({}, {"_id": 0, "waifu_id": 1, "name": 1, "img": 1}).to_list(None)
+    WAIFU_CACHE = docs
+    logger.info(f"Waifu cache loaded: {len(docs)}")
+
+async def refresh_waifu_cache():
+    # concurrent callers share one in-flight load instead of each querying the DB
+    global _waifu_cache_task
+    if _waifu_cache_task is None or _waifu_cache_task.done():
+        _waifu_cache_task = asyncio.create_task(_load_waifu_cache())
+    await asyncio.shield(_waifu_cache_task)
+
+async def waifu_cache_refresher():
+    # periodically reload the cache so waifus added to the DB show up
+    while True:
+        await asyncio.sleep(WAIFU_CACHE_TTL)
+        try:
+            await refresh_waifu_cache()
+        except Exception:
+            logger.exception("Failed to refresh waifu cache")
 
 async def choose_random_waifu_async():
-    count = await db.waifus.count_documents({})
-    if count == 0:
+    # cache still empty (e.g. the DB was empty at startup): join the load in
+    # flight or start one, at most once per WAIFU_CACHE_MISS_RETRY so a burst
+    # of /catch can't stampede the DB
+    loading = _waifu_cache_task is not None and not _waifu_cache_task.done()
+    if not WAIFU_CACHE and (loading or time.monotonic() - WAIFU_CACHE_LAST_LOAD >= WAIFU_CACHE_MISS_RETRY):
+        try:
+            await refresh_waifu_cache()
+        except Exception:
+            logger.exception("Failed to load waifu cache")
+    if not WAIFU_CACHE:
         return None
-    # use aggregation sample for randomness
-    cur = db.waifus.aggregate([{"$sample": {"size": 1}}])
-    docs = await cur.to_list(1)
-    return docs[0] if docs else None
+    return random.choice(WAIFU_CACHE)
+
+async def get_display_name(uid: int) -> str:
+    cached = NAME_CACHE.get(uid)
+    if cached and time.monotonic() - cached[1] < NAME_CACHE_TTL:
+        return cached[0]
+    try:
+        member = await bot.get_chat(uid)
+        name = member.full_name
+    except Exception:
+        # don't cache failures, try again next time
+        return str(uid)
+    NAME_CACHE[uid] = (name, time.monotonic())
+    return name
+
+async def send_waifu(msg: types.Message, img, caption: str):
+    if img:
+        try:
+            await msg.answer_photo(img, caption)
+            return
+        except Exception:
+            pass
+    await msg.answer(caption)
+
+async def undo_claim(user_id: int, pend: Dict[str, Any], inventory_done: bool, counters_done: bool):
+    # back out whichever half of a failed claim went through and give the
+    # pending waifu back, so inventory and counters stay in step
+    rarity = pend["rarity"]
+    try:
+        if inventory_done:
+            key = {"user_id": user_id, "waifu_id": pend["waifu_id"]}
+            await db.inventory.update_one(key, {"$inc": {"count": -1}})
+            await db.inventory.delete_one({**key, "count": {"$lte": 0}})
+        if counters_done:
+            await db.users.update_one({"user_id": user_id}, {"$inc": {"total_waifus": -1, f"rarity_counts.{rarity}": -1}})
+        await db.pending.update_one(
+            {"user_id": user_id},
+            {"$setOnInsert": {"waifu_id": pend["waifu_id"], "name": pend["name"], "img": pend.get("img"), "rarity": rarity, "ts": int(time.time())}},
+            upsert=True
+        )
+    except Exception:
+        logger.exception(f"Failed to roll back claim for {user_id}: {pend}")
 
 def pick_rarity():
-    # choose from weighted list built above
-    return random.choice(RARITY_CHOICES)
+    # weighted pick using the cumulative weights built above
+    return random.choices(RARITY_NAMES, cum_weights=RARITY_CUM, k=1)[0]
 
 # ---------- COMMANDS ----------
 @dp.message(Command("start"))
 async def cmd_start(msg: types.Message):
-    text = (
-        "🔥 Welcome to Waifu Catcher!\n\n"
-        "Commands:\n"
-        "/catch - roll for a waifu (then /claim)\n"
-        "/claim - claim your last rolled waifu\n"
-        "/inventory - see your collection\n"
-        "/profile - your stats\n"
-        "/leaderboard - top collectors\n"
-    )
-    await msg.answer(text)
+    await msg.answer(START_TEXT)
 
 @dp.message(Command("catch"))
 async def cmd_catch(msg: types.Message):
     user_id = msg.from_user.id
 
-    # cooldown check
-    pending = await db.pending.find_one({"user_id": user_id})
-    last_ts = 0
-    if pending and "ts" in pending:
-        last_ts = pending["ts"]
-    # But we'll store cooldown per-user in users collection as well
-    userdoc = await db.users.find_one({"user_id": user_id})
-    last_catch = userdoc.get("last_catch", 0) if userdoc else 0
-    now = int(time.time())
-    if now - last_catch < COOLDOWN_SECONDS:
-        remain = COOLDOWN_SECONDS - (now - last_catch)
-        await msg.answer(f"⏳ Wait {remain}s before catching again.")
-        return
-
-    # pick waifu
+    # pick waifu (in-memory, so do it before touching the DB)
     w = await choose_random_waifu_async()
     if not w:
         await msg.answer("No waifus loaded yet. Contact the admin.")
         return
 
+    # cooldown check: only set last_catch if the cooldown has passed.
+    # The unique index on user_id makes the upsert fail instead of
+    # inserting a second doc when the user exists but is on cooldown.
+    now = int(time.time())
+    try:
+        await users_fast.update_one(
+            {"user_id": user_id, "$or": [{"last_catch": {"$exists": False}}, {"last_catch": {"$lte": now - COOLDOWN_SECONDS}}]},
+            {"$set": {"last_catch": now}},
+            upsert=True
+        )
+    except DuplicateKeyError:
+        userdoc = await db.users.find_one({"user_id": user_id}, {"_id": 0, "last_catch": 1})
+        last_catch = userdoc.get("last_catch", 0) if userdoc else 0
+        remain = max(COOLDOWN_SECONDS - (now - last_catch), 1)
+        await msg.answer(f"⏳ Wait {remain}s before catching again.")
+        return
+
     rarity = pick_rarity()
 
-    # save pending
-    await db.pending.update_one(
-        {"user_id": user_id},
-        {"$set": {"user_id": user_id, "waifu_id": w["waifu_id"], "name": w["name"], "img": w.get("img"), "rarity": rarity, "ts": now}},
-        upsert=True
-    )
-    # update user's last_catch timestamp
-    await db.users.update_one({"user_id": user_id}, {"$set": {"last_catch": now}}, upsert=True)
-
-    caption = (
-        f"🎴 A Waifu appeared!\n\n"
-        f"❤️ Name: {w['name']}\n"
-        f"⭐ Rarity: {rarity}\n\n"
-        "Use /claim to add her to your collection."
-    )
-    if w.get("img"):
-        try:
-            await msg.answer_photo(w.get("img"), caption)
-        except Exception:
-            await msg.answer(caption)
-    else:
-        await msg.answer(caption)
+    # save pending before showing the waifu, so users never see one they can't /claim
+    try:
+        await pending_coll.update_one(
+            {"user_id": user_id},
+            {"$set": {"user_id": user_id, "waifu_id": w["waifu_id"], "name": w["name"], "img": w.get("img"), "rarity": rarity, "ts": now}},
+            upsert=True
+        )
+    except Exception:
+        logger.exception("Failed to save pending catch")
+        # give the cooldown back since nothing was caught
+        await users_fast.update_one({"user_id": user_id, "last_catch": now}, {"$unset": {"last_catch": ""}})
+        await msg.answer("⚠️ Something went wrong, please /catch again.")
+        return
+
+    caption = CATCH_TEMPLATE.format(name=w["name"], rarity=rarity)
+    await send_waifu(msg, w.get("img"), caption)
 
 @dp.message(Command("claim"))
 async def cmd_claim(msg: types.Message):
     user_id = msg.from_user.id
-    pend = await db.pending.find_one({"user_id": user_id})
+    # taking the pending doc is what grants the claim, so a double-tapped
+    # /claim can only succeed once. Journaled (db.pending, not pending_coll)
+    # so a crash can't bring it back to be claimed twice.
+    pend = await db.pending.find_one_and_delete(
+        {"user_id": user_id},
+        projection={"_id": 0, "waifu_id": 1, "name": 1, "img": 1, "rarity": 1}
+    )
     if not pend:
         await msg.answer("❌ You have no waifu to claim. Use /catch first.")
         return
 
-    # add to user's collection (increment count if already owned)
-    waifu_entry = {
-        "waifu_id": pend["waifu_id"],
-        "name": pend["name"],
-        "img": pend.get("img"),
-        "rarity": pend["rarity"],
-        "claimed_ts": int(time.time()),
-    }
-    # upsert: if user doc exists update list
-    await db.users.update_one(
-        {"user_id": user_id},
-        {"$inc": {}, "$setOnInsert": {"user_id": user_id}},
-        upsert=True
+    # add to user's inventory (increment count if already owned) and bump the
+    # user's counters; the writes are independent so run them together
+    rarity = pend["rarity"]
+    entry, counted = await asyncio.gather(
+        db.inventory.find_one_and_update(
+            {"user_id": user_id, "waifu_id": pend["waifu_id"]},
+            {
+                "$inc": {"count": 1},
+                "$setOnInsert": {"name": pend["name"], "img": pend.get("img"), "rarity": rarity},
+            },
+            upsert=True,
+            projection={"_id": 0, "name": 1, "rarity": 1, "count": 1},
+            return_document=ReturnDocument.AFTER
+        ),
+        db.users.update_one(
+            {"user_id": user_id},
+            {"$inc": {"total_waifus": 1, f"rarity_counts.{rarity}": 1}},
+            upsert=True
+        ),
+        return_exceptions=True,
     )
+    if isinstance(entry, Exception) or isinstance(counted, Exception):
+        for what, res in (("inventory", entry), ("counters", counted)):
+            if isinstance(res, Exception):
+                logger.error(f"Claim {what} write failed for {user_id}", exc_info=res)
+        await undo_claim(user_id, pend, not isinstance(entry, Exception), not isinstance(counted, Exception))
+        await msg.answer("⚠️ Something went wrong, please /claim again.")
+        return
 
-    # increment if exists in subcollection, else push new object with count
-    # We'll store collection as dict: waifus_map: {waifu_id: {name,img,rarity,count}}
-    user_doc = await db.users.find_one({"user_id": user_id})
-    waifus_map = user_doc.get("waifus_map", {}) if user_doc else {}
-
-    wid = waifu_entry["waifu_id"]
-    if wid in waifus_map:
-        waifus_map[wid]["count"] = waifus_map[wid].get("count", 1) + 1
-    else:
-        waifus_map[wid] = {
-            "name": waifu_entry["name"],
-            "img": waifu_entry.get("img"),
-            "rarity": waifu_entry["rarity"],
-            "count": 1
-        }
-
-    await db.users.update_one({"user_id": user_id}, {"$set": {"waifus_map": waifus_map}})
-
-    # remove pending
-    await db.pending.delete_one({"user_id": user_id})
-
-    await msg.answer(f"✅ You claimed {waifus_map[wid]['name']} ({waifus_map[wid]['rarity']}). You now have {waifus_map[wid]['count']} of them.")
+    await msg.answer(f"✅ You claimed {entry['name']} ({entry['rarity']}). You now have {entry['count']} of them.")
 
 @dp.message(Command("inventory"))
-async def cmd_inventory(msg: types.Message):
+async def cmd_inventory(msg: types.Message, command: CommandObject):
     user_id = msg.from_user.id
-    user_doc = await db.users.find_one({"user_id": user_id})
-    waifus_map = user_doc.get("waifus_map", {}) if user_doc else {}
-    if not waifus_map:
-        await msg.answer("📦 Your collection is empty.")
+    try:
+        page = int(command.args) if command.args else 1
+    except ValueError:
+        page = 1
+    page = min(max(page, 1), INVENTORY_MAX_PAGE)
+    skip = (page - 1) * INVENTORY_PAGE_SIZE
+    cursor = db.inventory.find({"user_id": user_id}, {"_id": 0, "name": 1, "rarity": 1, "count": 1})
+    cursor = cursor.sort([("count", -1), ("rarity", 1), ("waifu_id", 1)]).skip(skip).limit(INVENTORY_PAGE_SIZE)
+    items = await cursor.to_list(INVENTORY_PAGE_SIZE)
+    if not items:
+        if page > 1:
+            await msg.answer(f"📦 No waifus on page {page}.")
+        else:
+            await msg.answer("📦 Your collection is empty.")
         return
-    # Build text (first 20 items)
-    lines = []
-    for i, (wid, info) in enumerate(sorted(waifus_map.items(), key=lambda x: (-x[1].get("count",0), x[1].get("rarity",""))), 1):
-        lines.append(f"{i}. {info['name']} — {info['rarity']} x{info['count']}")
-        if i >= 20: break
-    txt = "📦 Your collection:\n\n" + "\n".join(lines)
+    lines = [f"{i}. {info['name']} — {info['rarity']} x{info['count']}" for i, info in enumerate(items, skip + 1)]
+    txt = f"📦 Your collection (page {page}):\n\n" + "\n".join(lines)
+    if len(items) == INVENTORY_PAGE_SIZE:
+        txt += f"\n\nNext page: /inventory {page + 1}"
     await msg.answer(txt)
 
 @dp.message(Command("profile"))
 async def cmd_profile(msg: types.Message):
     user_id = msg.from_user.id
-    user_doc = await db.users.find_one({"user_id": user_id})
-    waifus_map = user_doc.get("waifus_map", {}) if user_doc else {}
-    total = sum(info.get("count", 0) for info in waifus_map.values())
-    rarity_counts = {}
-    for info in waifus_map.values():
-        rarity_counts[info.get("rarity","Unknown")] = rarity_counts.get(info.get("rarity","Unknown"), 0) + info.get("count",0)
+    user_doc = await db.users.find_one({"user_id": user_id}, {"_id": 0, "total_waifus": 1, "rarity_counts": 1}) or {}
+    total = user_doc.get("total_waifus", 0)
+    rarity_counts = user_doc.get("rarity_counts", {})
     rtext = "\n".join(f"{k}: {v}" for k,v in rarity_counts.items()) or "None"
     await msg.answer(f"👤 Profile\nTotal waifus: {total}\n\nRarity counts:\n{rtext}")
 
 @dp.message(Command("leaderboard"))
 async def cmd_leaderboard(msg: types.Message):
-    # aggregate top users by total waifus
-    cursor = db.users.find({})
-    docs = await cursor.to_list(length=100)
-    scores = []
-    for d in docs:
-        wm = d.get("waifus_map", {})
-        total = sum(v.get("count",0) for v in wm.values())
-        if total > 0:
-            scores.append((d["user_id"], total))
-    top = sorted(scores, key=lambda x: -x[1])[:10]
+    # top users by the total_waifus counter (indexed)
+    cursor = db.users.find({"total_waifus": {"$gt": 0}}, {"_id": 0, "user_id": 1, "total_waifus": 1})
+    cursor = cursor.sort("total_waifus", -1).limit(10)
+    top = [(d["user_id"], d["total_waifus"]) async for d in cursor]
     if not top:
         await msg.answer("No data yet.")
         return
-    lines = []
-    for rank, (uid, score) in enumerate(top, 1):
-        try:
-            member = await bot.get_chat(uid)
-            name = member.full_name
-        except Exception:
-            name = str(uid)
-        lines.append(f"{rank}. {name} — {score}")
+    names = await asyncio.gather(*(get_display_name(uid) for uid, _ in top))
+    lines = [f"{rank}. {name} — {score}" for rank, (name, (_, score)) in enumerate(zip(names, top), 1)]
     await msg.answer("🏆 Leaderboard\n\n" + "\n".join(lines))
 
 # ---------- STARTUP ----------
 
 async def on_startup():
-    logger.info("Starting up: ensuring waifus loaded...")
+    logger.info("Starting up: ensuring indexes...")
+    # duplicates can only predate the unique indexes, so only clean up
+    # collections whose index hasn't been built yet
+    users_idx, pending_idx, waifus_idx = await asyncio.gather(
+        db.users.index_information(),
+        pending_coll.index_information(),
+        db.waifus.index_information(),
+    )
+    cleanups = []
+    if "user_id_1" not in users_idx:
+        cleanups.append(merge_duplicate_users())
+    if "user_id_1" not in pending_idx:
+        cleanups.append(dedupe_by(pending_coll, "user_id"))
+    if "waifu_id_1" not in waifus_idx:
+        cleanups.append(dedupe_by(db.waifus, "waifu_id"))
+    await asyncio.gather(*cleanups)
+    await asyncio.gather(
+        db.users.create_index("user_id", unique=True),
+        pending_coll.create_index("user_id", unique=True),
+        db.waifus.create_index("waifu_id", unique=True),
+        db.users.create_index([("total_waifus", -1)]),
+        db.inventory.create_index([("user_id", 1), ("waifu_id", 1)], unique=True),
+        # matches the /inventory sort so pages don't need an in-memory sort
+        db.inventory.create_index([("user_id", 1), ("count", -1), ("rarity", 1), ("waifu_id", 1)]),
+    )
+    # superseded by the index above
+    if "user_id_1_count_-1" in await db.inventory.index_information():
+        await db.inventory.drop_index("user_id_1_count_-1")
+    await migrate_legacy_users()
+    logger.info("Ensuring waifus loaded...")
     await ensure_waifus_loaded()
+    await refresh_waifu_cache()
     logger.info("Bot started.")
 
 async def main():
     await on_startup()
+    refresher = asyncio.create_task(waifu_cache_refresher())
     try:
         logger.info("Polling started.")
         await dp.start_polling(bot)
     finally:
+        refresher.cancel()
         await bot.session.close()
 
 if __name__ == "__main__":